@@ -1,18 +1,24 @@
 import argparse
+import concurrent.futures
 import datetime
 import os
 import socket
 import sys
+import time
+
+from typing import Tuple
 
 import numpy as np
 from tensorboardX import SummaryWriter
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.optim
 
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import SGD, Adam
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler
 
 from util.util import enumerateWithEstimate
 from .dsets import Luna2dSegmentationDataset, TrainingLuna2dSegmentationDataset, getCt
@@ -40,6 +46,101 @@ METRICS_AFP_NDX = 9
 
 METRICS_SIZE = 10
 
+# Scripted once at import time, so the TorchScript fuser can fold the pointwise
+# tail of the loss into a single kernel without recompiling on every call
+@torch.jit.script
+def computeDiceLoss(label_devtensor: torch.Tensor, prediction_devtensor: torch.Tensor, epsilon: float) -> Tuple[torch.Tensor, torch.Tensor]:
+    # A 512x512 fp16 sum can overflow, so make sure we reduce in fp32
+    label_devtensor = label_devtensor.float()
+    prediction_devtensor = prediction_devtensor.float()
+
+    # Reduce each input in place and only stack the (N,) results; rows are (label, prediction, correct)
+    sum_devtensor = torch.stack([
+        label_devtensor.flatten(1).sum(dim=1),
+        prediction_devtensor.flatten(1).sum(dim=1),
+        (prediction_devtensor * label_devtensor).flatten(1).sum(dim=1),
+    ])
+
+    diceLoss_devtensor = 1 - (2 * sum_devtensor[2] + epsilon) / (sum_devtensor[1] + sum_devtensor[0] + epsilon)
+    return diceLoss_devtensor, sum_devtensor
+
+def copyToCpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: copyToCpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copyToCpu(value) for value in obj)
+    return obj
+
+class _ContiguousDistributedSampler(Sampler):
+    """
+    Hands each rank one contiguous block of indices, rather than the
+    strided r, r+W, r+2W, ... that `DistributedSampler` produces. The
+    training dataset picks CTs and slice types from index arithmetic
+    (`ndx % batch_size`, `ndx % 3`, `ndx % ctCache_depth`), which a
+    strided split would pin to a constant per rank.
+
+    The last block wraps around to the start of the dataset so every
+    rank sees the same number of samples; since those duplicates end up
+    at the tail of the rank-ordered all_gather, they can be trimmed off.
+    """
+    def __init__(self, ds, rank, world_size):
+        self.ds_len = len(ds)
+        self.per_rank = (self.ds_len + world_size - 1) // world_size
+        self.start_ndx = rank * self.per_rank
+
+    def __len__(self):
+        return self.per_rank
+
+    def __iter__(self):
+        return iter([ndx % self.ds_len for ndx in range(self.start_ndx, self.start_ndx + self.per_rank)])
+
+class _CudaPrefetcher(object):
+    """
+    Wraps a DataLoader so that the host-to-device copies for the next
+    batch are issued on a side stream while the current batch is being
+    computed. Modeled on the NVIDIA APEX `data_prefetcher`.
+
+    Tensors in the yielded batch tuples are already on `device`; other
+    items (series UIDs, etc.) are passed through untouched.
+    """
+    def __init__(self, dl, device):
+        self.dl = dl
+        self.device = device
+        self.copy_stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.dl)
+
+    def __iter__(self):
+        batch_iter = iter(self.dl)
+        next_tup = self._preload(next(batch_iter, None))
+
+        while next_tup is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.copy_stream)
+
+            batch_tup = next_tup
+            for item in batch_tup:
+                if isinstance(item, torch.Tensor):
+                    # Memory was allocated on the copy stream but gets used on this one
+                    item.record_stream(current_stream)
+
+            # Start copying the following batch before handing this one out
+            next_tup = self._preload(next(batch_iter, None))
+            yield batch_tup
+
+    def _preload(self, batch_tup):
+        if batch_tup is None:
+            return None
+
+        with torch.cuda.stream(self.copy_stream):
+            return tuple(
+                item.to(self.device, non_blocking=True) if isinstance(item, torch.Tensor) else item
+                for item in batch_tup
+            )
+
 class LunaTrainingApp(object):
     def __init__(self, sys_argv=None):
         if sys_argv is None:
@@ -61,6 +162,11 @@ class LunaTrainingApp(object):
             default=1,
             type=int,
         )
+        parser.add_argument('--save-every',
+            help='Only save a numbered checkpoint every N epochs; the best model is always saved',
+            default=1,
+            type=int,
+        )
 
         parser.add_argument('--augmented',
             help="Augment the training data.",
@@ -109,6 +215,14 @@ class LunaTrainingApp(object):
         self.totalTrainingSamples_count = 0
         self.trn_writer = None
         self.tst_writer = None
+        self.metrics_tensor_dict = {}
+        self.logImageSamples_dict = {}
+        # PNG encoding in add_image is slow; a single worker keeps the images in order
+        self.image_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.imageFuture_list = []
+        # Checkpoints are written in the background so the next epoch can start right away
+        self.save_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.save_future = None
 
         augmentation_dict = {}
         if self.cli_args.augmented or self.cli_args.augment_flip:
@@ -122,21 +236,66 @@ class LunaTrainingApp(object):
         self.use_cuda = torch.cuda.is_available()
         self.device = torch.device("cuda" if self.use_cuda else "cpu")
 
+        # Our inputs are always 8x512x512, so let cuDNN pick the fastest conv algorithms once
+        torch.backends.cudnn.benchmark = True
+
+        # torchrun sets LOCAL_RANK; in that case we run one process per GPU
+        self.use_ddp = self.use_cuda and 'LOCAL_RANK' in os.environ
+        self.local_rank = 0
+        if self.use_ddp:
+            self.local_rank = int(os.environ['LOCAL_RANK'])
+            dist.init_process_group(backend='nccl')
+            torch.cuda.set_device(self.local_rank)
+            self.device = torch.device("cuda", self.local_rank)
+        self.is_rank0 = not self.use_ddp or dist.get_rank() == 0
+
+        if self.use_ddp:
+            # torch's default seed is the same in every process, which would give every rank
+            # (and its DataLoader workers) identical random draws for sampling and augmentation
+            torch.manual_seed(torch.initial_seed() + dist.get_rank())
+
+        # Number of GPUs each optimizer step is spread across, and the resulting total batch size
+        if self.use_ddp:
+            self.device_count = dist.get_world_size()
+        else:
+            self.device_count = torch.cuda.device_count() if self.use_cuda else 1
+        self.effective_batch_size = self.cli_args.batch_size * self.device_count
+
         self.model = self.initModel()
+        self.compiled_model = self.compileModel(self.model)
         self.optimizer = self.initOptimizer()
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_cuda)
 
 
     def initModel(self):
         model = UNetWrapper(in_channels=8, n_classes=1, depth=4, wf=3, padding=True, batch_norm=True, up_mode='upconv')
 
-        if self.use_cuda:
-            if torch.cuda.device_count() > 1:
+        if self.use_ddp:
+            model = model.to(self.device, memory_format=torch.channels_last)
+            model = DistributedDataParallel(model, device_ids=[self.local_rank])
+        elif self.use_cuda:
+            model = model.to(memory_format=torch.channels_last)
+            if self.device_count > 1:
                 model = nn.DataParallel(model)
             model = model.to(self.device)
         return model
 
+    def compileModel(self, model):
+        # torch.compile needs PyTorch 2.0+, and only pays off on the GPU
+        if not self.use_cuda or not hasattr(torch, 'compile'):
+            return model
+
+        # DataParallel runs its replicas in worker threads that Dynamo doesn't trace, so
+        # compiling the wrapper would leave the U-Net itself eager; don't bother
+        if isinstance(model, nn.DataParallel):
+            return model
+
+        # CUDA graphs don't mix with DDP's gradient all-reduce hooks
+        mode = 'default' if self.use_ddp else 'reduce-overhead'
+        return torch.compile(model, mode=mode)
+
     def initOptimizer(self):
-        return SGD(self.model.parameters(), lr=0.001, momentum=0.99)
+        return SGD(self.model.parameters(), lr=0.001, momentum=0.99, foreach=True)
         # return Adam(self.model.parameters())
 
 
@@ -145,14 +304,17 @@ class LunaTrainingApp(object):
             test_stride=10,
             isTestSet_bool=False,
             contextSlices_count=3,
-            augmentation_dict=self.augmentation_dict,
+            # Augmentation happens batch-wise on the GPU in augmentBatch instead
+            augmentation_dict=None,
         )
 
         train_dl = DataLoader(
             train_ds,
-            batch_size=self.cli_args.batch_size * (torch.cuda.device_count() if self.use_cuda else 1),
+            batch_size=self.getBatchSize(),
             num_workers=self.cli_args.num_workers,
             pin_memory=self.use_cuda,
+            sampler=self.getSampler(train_ds),
+            **self.getWorkerKwargs(),
         )
 
         return train_dl
@@ -166,19 +328,61 @@ class LunaTrainingApp(object):
 
         test_dl = DataLoader(
             test_ds,
-            batch_size=self.cli_args.batch_size * (torch.cuda.device_count() if self.use_cuda else 1),
+            batch_size=self.getBatchSize(),
             num_workers=self.cli_args.num_workers,
             pin_memory=self.use_cuda,
+            sampler=self.getSampler(test_ds),
+            **self.getWorkerKwargs(),
         )
 
         return test_dl
 
+    def getBatchSize(self):
+        # Under DDP every process gets its own loader, so the batch size is per GPU
+        if self.use_ddp:
+            return self.cli_args.batch_size
+        return self.effective_batch_size
+
+    def getSampler(self, ds):
+        if not self.use_ddp:
+            return None
+        return _ContiguousDistributedSampler(ds, dist.get_rank(), self.device_count)
+
+    def getWorkerKwargs(self):
+        if self.cli_args.num_workers == 0:
+            return {}
+        # prefetch_factor counts *batches* per worker. A sample is the 8x512x512 float32
+        # input plus three 512x512 float32 masks (~11MB), so with the defaults (batch 16,
+        # 8 workers) every extra batch of prefetch is ~1.4GB in flight, and the
+        # DataParallel fallback multiplies the batch by the GPU count. Keep all prefetched
+        # batches under 1/8 of physical RAM, between 1 and 4 batches per worker.
+        batch_bytes = self.getBatchSize() * (8 + 3) * 512 * 512 * 4
+        try:
+            budget_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 8
+            prefetch_factor = max(1, min(4, budget_bytes // (batch_bytes * self.cli_args.num_workers)))
+        except (AttributeError, ValueError, OSError):
+            # No sysconf (e.g. Windows); fall back to the DataLoader default
+            prefetch_factor = 2
+
+        # Keeping the workers alive between epochs also keeps their getCt caches warm
+        return {
+            'persistent_workers': True,
+            'prefetch_factor': prefetch_factor,
+        }
+
+    def prefetch(self, dl):
+        # The loaders use pin_memory on CUDA, so the side-stream copies can run asynchronously
+        if not self.use_cuda:
+            return dl
+        return _CudaPrefetcher(dl, self.device)
+
     def initTensorboardWriters(self):
         if self.trn_writer is None:
             log_dir = os.path.join('runs', self.cli_args.tb_prefix, self.time_str)
 
-            self.trn_writer = SummaryWriter(log_dir=log_dir + '_trn_seg_' + self.cli_args.comment)
-            self.tst_writer = SummaryWriter(log_dir=log_dir + '_tst_seg_' + self.cli_args.comment)
+            # Events are queued and flushed in the background rather than hitting disk every few calls
+            self.trn_writer = SummaryWriter(log_dir=log_dir + '_trn_seg_' + self.cli_args.comment, max_queue=1000, flush_secs=120)
+            self.tst_writer = SummaryWriter(log_dir=log_dir + '_tst_seg_' + self.cli_args.comment, max_queue=1000, flush_secs=120)
 
     def main(self):
         log.info("Starting {}, {}".format(type(self).__name__, self.cli_args))
@@ -196,123 +400,230 @@ class LunaTrainingApp(object):
                 len(train_dl),
                 len(test_dl),
                 self.cli_args.batch_size,
-                (torch.cuda.device_count() if self.use_cuda else 1),
+                self.device_count,
             ))
 
             trainingMetrics_tensor = self.doTraining(epoch_ndx, train_dl)
             self.logMetrics(epoch_ndx, 'trn', trainingMetrics_tensor)
-            self.logImages(epoch_ndx, 'trn', train_dl)
-            self.logImages(epoch_ndx, 'tst', test_dl)
+            if self.is_rank0:
+                # Last epoch's images have had a whole training pass to finish encoding
+                self.waitForImages()
+                self.logImages(epoch_ndx, 'trn', train_dl)
+                self.logImages(epoch_ndx, 'tst', test_dl)
             # self.logModelMetrics(self.model)
 
             testingMetrics_tensor = self.doTesting(epoch_ndx, test_dl)
             score = self.logMetrics(epoch_ndx, 'tst', testingMetrics_tensor)
             best_score = max(score, best_score)
 
-            self.saveModel('seg', epoch_ndx, score == best_score)
+            if self.is_rank0:
+                self.saveModel('seg', epoch_ndx, score == best_score)
 
-        if hasattr(self, 'trn_writer'):
+        self.save_pool.shutdown(wait=True)
+        if self.save_future is not None:
+            self.save_future.result()
+
+        if self.trn_writer is not None:
+            self.waitForImages()
+            self.image_pool.shutdown(wait=True)
             self.trn_writer.close()
             self.tst_writer.close()
 
+        if self.use_ddp:
+            dist.destroy_process_group()
+
+    def initMetricsTensor(self, mode_str, dl):
+        # One row per sample, so each batch can be copied back into a contiguous slice.
+        # Pinned memory lets those device->host copies run asynchronously.
+        # Pinning is expensive, so the buffer is allocated once and reused every epoch.
+        metrics_tensor = self.metrics_tensor_dict.get(mode_str)
+        if metrics_tensor is None:
+            metrics_tensor = torch.zeros(len(dl.sampler), METRICS_SIZE, pin_memory=self.use_cuda)
+            self.metrics_tensor_dict[mode_str] = metrics_tensor
+        else:
+            metrics_tensor.zero_()
+        return metrics_tensor
+
     def doTraining(self, epoch_ndx, train_dl):
-        trainingMetrics_devtensor = torch.zeros(METRICS_SIZE, len(train_dl.dataset)).to(self.device)
+        trainingMetrics_tensor = self.initMetricsTensor('trn', train_dl)
         self.model.train()
 
         batch_iter = enumerateWithEstimate(
-            train_dl,
+            self.prefetch(train_dl),
             "E{} Training".format(epoch_ndx),
             start_ndx=train_dl.num_workers,
         )
+        # Outstanding DataParallel work can throw off cudnn.benchmark's algorithm
+        # search, so let the first few steps finish before starting the next one
+        warmup_count = 5 if isinstance(self.model, nn.DataParallel) else 0
+
         for batch_ndx, batch_tup in batch_iter:
-            self.optimizer.zero_grad()
+            start_ts = time.time()
+            self.optimizer.zero_grad(set_to_none=True)
 
-            loss_var = self.computeBatchLoss(batch_ndx, batch_tup, train_dl.batch_size, trainingMetrics_devtensor)
-            loss_var.backward()
+            batch_tup = self.augmentBatch(batch_tup)
+            loss_var = self.computeBatchLoss(batch_ndx, batch_tup, train_dl.batch_size, trainingMetrics_tensor)
+            self.scaler.scale(loss_var).backward()
 
-            self.optimizer.step()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
             del loss_var
 
-        self.totalTrainingSamples_count += trainingMetrics_devtensor.size(1)
+            if batch_ndx < warmup_count:
+                torch.cuda.synchronize()
+                log.debug("E{} warm-up batch {}: {:.3f}s".format(
+                    epoch_ndx,
+                    batch_ndx,
+                    time.time() - start_ts,
+                ))
+
+        trainingMetrics_tensor = self.gatherMetrics(trainingMetrics_tensor, train_dl)
+        self.totalTrainingSamples_count += trainingMetrics_tensor.size(0)
 
-        return trainingMetrics_devtensor.to('cpu')
+        return trainingMetrics_tensor.t()
 
     def doTesting(self, epoch_ndx, test_dl):
-        with torch.no_grad():
-            testingMetrics_devtensor = torch.zeros(METRICS_SIZE, len(test_dl.dataset)).to(self.device)
+        with torch.inference_mode():
+            testingMetrics_tensor = self.initMetricsTensor('tst', test_dl)
             self.model.eval()
 
             batch_iter = enumerateWithEstimate(
-                test_dl,
+                self.prefetch(test_dl),
                 "E{} Testing ".format(epoch_ndx),
                 start_ndx=test_dl.num_workers,
             )
             for batch_ndx, batch_tup in batch_iter:
-                self.computeBatchLoss(batch_ndx, batch_tup, test_dl.batch_size, testingMetrics_devtensor)
+                self.computeBatchLoss(batch_ndx, batch_tup, test_dl.batch_size, testingMetrics_tensor)
+
+            testingMetrics_tensor = self.gatherMetrics(testingMetrics_tensor, test_dl)
+
+        return testingMetrics_tensor.t()
+
+    def gatherMetrics(self, metrics_tensor, dl):
+        if self.use_cuda:
+            # The per-batch copies into metrics_tensor are non_blocking
+            torch.cuda.synchronize(self.device)
+
+        if not self.use_ddp:
+            return metrics_tensor
+
+        # Each row is one sample, so the per-rank tensors get concatenated rather than summed
+        metrics_devtensor = metrics_tensor.to(self.device)
+        gathered_list = [torch.zeros_like(metrics_devtensor) for _ in range(self.device_count)]
+        dist.all_gather(gathered_list, metrics_devtensor)
+
+        # Drop the wrapped-around duplicates the sampler padded the last rank with
+        return torch.cat(gathered_list, dim=0)[:len(dl.dataset)].to('cpu')
+
+    def augmentBatch(self, batch_tup):
+        if not self.augmentation_dict:
+            return batch_tup
 
-        return testingMetrics_devtensor.to('cpu')
+        input_tensor, label_tensor, label_list, ben_tensor, mal_tensor, series_list, start_list = batch_tup
 
-    def computeBatchLoss(self, batch_ndx, batch_tup, batch_size, metrics_devtensor):
+        # Same augmentations Luna2dSegmentationDataset does per sample on the CPU workers,
+        # but applied to the whole batch at once on the device
+        spatial_list = [
+            input_tensor.to(self.device, non_blocking=True),
+            label_tensor.to(self.device, non_blocking=True),
+            ben_tensor.to(self.device, non_blocking=True),
+            mal_tensor.to(self.device, non_blocking=True),
+        ]
+        batch_size = input_tensor.size(0)
+
+        def applyRandomly(t_list, op):
+            # One coin flip per sample, shared by the CT and all of its masks
+            apply_devtensor = torch.rand(batch_size, device=self.device) > 0.5
+            return [
+                torch.where(apply_devtensor.view(-1, *[1] * (t.dim() - 1)), op(t), t)
+                for t in t_list
+            ]
+
+        if 'rotate' in self.augmentation_dict:
+            spatial_list = applyRandomly(spatial_list, lambda t: t.rot90(1, [-2, -1]))
+
+        if 'flip' in self.augmentation_dict:
+            spatial_list = applyRandomly(spatial_list, lambda t: t.flip([-2]))
+            spatial_list = applyRandomly(spatial_list, lambda t: t.flip([-1]))
+
+        input_devtensor, label_devtensor, ben_devtensor, mal_devtensor = spatial_list
+
+        if 'noise' in self.augmentation_dict:
+            input_devtensor = torch.randn_like(input_devtensor).mul_(self.augmentation_dict['noise']).add_(input_devtensor)
+
+        return input_devtensor, label_devtensor, label_list, ben_devtensor, mal_devtensor, series_list, start_list
+
+    def computeBatchLoss(self, batch_ndx, batch_tup, batch_size, metrics_tensor):
         input_tensor, label_tensor, label_list, ben_tensor, mal_tensor, _series_list, _start_list = batch_tup
 
         input_devtensor = input_tensor.to(self.device, non_blocking=True)
+        input_devtensor = input_devtensor.contiguous(memory_format=torch.channels_last)
         label_devtensor = label_tensor.to(self.device, non_blocking=True)
-        mal_devtensor = mal_tensor.to(self.device, non_blocking=True)
-        ben_devtensor = ben_tensor.to(self.device, non_blocking=True)
+        # The masks come without a channel dim; add one so they line up with label/prediction
+        mal_devtensor = mal_tensor.unsqueeze(1).to(self.device, non_blocking=True)
+        ben_devtensor = ben_tensor.unsqueeze(1).to(self.device, non_blocking=True)
 
         start_ndx = batch_ndx * batch_size
         end_ndx = start_ndx + label_tensor.size(0)
-        intersectionSum = lambda a, b: (a * b).view(a.size(0), -1).sum(dim=1)
 
-        prediction_devtensor = self.model(input_devtensor)
+        # Only the U-Net runs in half precision; the dice sums below stay in fp32
+        with torch.cuda.amp.autocast(enabled=self.use_cuda):
+            prediction_devtensor = self.compiled_model(input_devtensor)
         diceLoss_devtensor = self.diceLoss(label_devtensor, prediction_devtensor)
 
         with torch.no_grad():
-            predictionBool_devtensor = (prediction_devtensor > 0.5).to(torch.float32)
+            # Writing the comparison straight into a float32 output does the threshold and the
+            # cast in one kernel, without an intermediate bool tensor of the same size
+            predictionBool_devtensor = torch.empty_like(prediction_devtensor, dtype=torch.float32)
+            torch.gt(prediction_devtensor, 0.5, out=predictionBool_devtensor)
 
-            metrics_devtensor[METRICS_LABEL_NDX, start_ndx:end_ndx] = label_list
-            metrics_devtensor[METRICS_LOSS_NDX, start_ndx:end_ndx] = diceLoss_devtensor
+            metrics_dict = {}
+            metrics_dict[METRICS_LABEL_NDX] = label_list.to(self.device, non_blocking=True).float()
+            metrics_dict[METRICS_LOSS_NDX] = diceLoss_devtensor
 
             # benPred_devtensor = predictionBool_devtensor * (1 - mal_devtensor)
-            tp = intersectionSum(    label_devtensor,     predictionBool_devtensor)
-            fn = intersectionSum(    label_devtensor, 1 - predictionBool_devtensor)
-            fp = intersectionSum(1 - label_devtensor,     predictionBool_devtensor)
-            # ls = self.diceLoss(label_devtensor, benPred_devtensor)
+            malPred_devtensor = predictionBool_devtensor * (1 - ben_devtensor)
 
-            metrics_devtensor[METRICS_ATP_NDX, start_ndx:end_ndx] = tp
-            metrics_devtensor[METRICS_AFN_NDX, start_ndx:end_ndx] = fn
-            metrics_devtensor[METRICS_AFP_NDX, start_ndx:end_ndx] = fp
-            # metrics_devtensor[METRICS_ALL_LOSS_NDX, start_ndx:end_ndx] = ls
+            sum_dim1 = lambda t: t.flatten(1).sum(dim=1)
 
-            del tp, fn, fp
+            # Every mask is 0/1, so only the true positives need a multiply; the false
+            # negatives and false positives fall out of the plain per-sample sums
+            tp = sum_dim1(label_devtensor * predictionBool_devtensor)
+            metrics_dict[METRICS_ATP_NDX] = tp
+            metrics_dict[METRICS_AFN_NDX] = sum_dim1(label_devtensor) - tp
+            metrics_dict[METRICS_AFP_NDX] = sum_dim1(predictionBool_devtensor) - tp
 
-            malPred_devtensor = predictionBool_devtensor * (1 - ben_devtensor)
-            tp = intersectionSum(    mal_devtensor,       malPred_devtensor)
-            fn = intersectionSum(    mal_devtensor,   1 - malPred_devtensor)
-            fp = intersectionSum(1 - label_devtensor,     malPred_devtensor)
-            ls = self.diceLoss(mal_devtensor, malPred_devtensor)
+            tp = sum_dim1(mal_devtensor * malPred_devtensor)
+            metrics_dict[METRICS_MTP_NDX] = tp
+            metrics_dict[METRICS_MFN_NDX] = sum_dim1(mal_devtensor) - tp
+            # metrics_dict[METRICS_MFP_NDX] = sum_dim1(malPred_devtensor) - sum_dim1(label_devtensor * malPred_devtensor)
 
-            metrics_devtensor[METRICS_MTP_NDX, start_ndx:end_ndx] = tp
-            metrics_devtensor[METRICS_MFN_NDX, start_ndx:end_ndx] = fn
-            # metrics_devtensor[METRICS_MFP_NDX, start_ndx:end_ndx] = fp
-            metrics_devtensor[METRICS_MAL_LOSS_NDX, start_ndx:end_ndx] = ls
+            # ls = self.diceLoss(label_devtensor, benPred_devtensor)
+            # metrics_dict[METRICS_ALL_LOSS_NDX] = ls
+            metrics_dict[METRICS_MAL_LOSS_NDX] = self.diceLoss(mal_devtensor, malPred_devtensor)
+
+            del malPred_devtensor, tp
+
+            # Gather the whole batch into one (batch, METRICS_SIZE) block and ship it
+            # to the host with a single copy, rather than one tiny write per metric
+            zero_devtensor = torch.zeros_like(diceLoss_devtensor)
+            batchMetrics_devtensor = torch.stack(
+                [metrics_dict.get(ndx, zero_devtensor) for ndx in range(METRICS_SIZE)],
+                dim=1,
+            )
+            metrics_tensor[start_ndx:end_ndx].copy_(batchMetrics_devtensor, non_blocking=True)
 
-            del malPred_devtensor, tp, fn, fp, ls
+            del metrics_dict, batchMetrics_devtensor
 
         return diceLoss_devtensor.mean()
 
     # def diceLoss(self, label_devtensor, prediction_devtensor, epsilon=0.01, p=False):
     def diceLoss(self, label_devtensor, prediction_devtensor, epsilon=1024, p=False):
-        sum_dim1 = lambda t: t.view(t.size(0), -1).sum(dim=1)
-
-        diceLabel_devtensor = sum_dim1(label_devtensor)
-        dicePrediction_devtensor = sum_dim1(prediction_devtensor)
-        diceCorrect_devtensor = sum_dim1(prediction_devtensor * label_devtensor)
-
-        epsilon_devtensor = torch.ones_like(diceCorrect_devtensor) * epsilon
-        diceLoss_devtensor = 1 - (2 * diceCorrect_devtensor + epsilon_devtensor) / (dicePrediction_devtensor + diceLabel_devtensor + epsilon_devtensor)
+        diceLoss_devtensor, sum_devtensor = computeDiceLoss(label_devtensor, prediction_devtensor, float(epsilon))
 
         if p:
+            diceLabel_devtensor, dicePrediction_devtensor, diceCorrect_devtensor = sum_devtensor
+
             log.debug([])
             log.debug(['diceCorrect_devtensor   ', diceCorrect_devtensor[0].item()])
             log.debug(['dicePrediction_devtensor', dicePrediction_devtensor[0].item()])
@@ -324,53 +635,79 @@ class LunaTrainingApp(object):
         return diceLoss_devtensor
 
 
-    def logImages(self, epoch_ndx, mode_str, dl):
-        for i, series_uid in enumerate(sorted(dl.dataset.series_list)[:12]):
-            ct = getCt(series_uid)
+    def getLogImageSamples(self, mode_str, dl):
+        # Loading a CT and building its masks is expensive, and the logged slices are the
+        # same every epoch, so we build them once and keep only what logImages needs: the
+        # 8x512x512 float32 input (8MB) and the three masks as bool (256KB each). That's
+        # ~8.8MB per slice, or ~1.2GB for 12 series x 5-6 slices x 2 splits.
+        if mode_str not in self.logImageSamples_dict:
+            sample_list = []
+            for i, series_uid in enumerate(sorted(dl.dataset.series_list)[:12]):
+                ct = getCt(series_uid)
 
-            for slice_ndx in range(0, ct.ary.shape[0], ct.ary.shape[0] // 5):
-                sample_tup = dl.dataset[(series_uid, slice_ndx, False)]
+                for slice_ndx in range(0, ct.ary.shape[0], ct.ary.shape[0] // 5):
+                    ct_tensor, nodule_tensor, _label_int, ben_tensor, mal_tensor, _series_uid, _ct_ndx = \
+                        dl.dataset[(series_uid, slice_ndx, False)]
 
-                ct_tensor, nodule_tensor, label_int, ben_tensor, mal_tensor, series_uid, ct_ndx = sample_tup
+                    # The same rescale every logged image gets; done once here rather than every epoch
+                    ct_tensor[:-1].add_(1000).div_(2000)
 
-                ct_tensor[:-1,:,:] += 1000
-                ct_tensor[:-1,:,:] /= 2000
+                    sample_list.append((
+                        i,
+                        slice_ndx,
+                        ct_tensor,
+                        nodule_tensor[0].bool(),
+                        ben_tensor.bool(),
+                        mal_tensor.bool(),
+                    ))
 
-                input_devtensor = ct_tensor.to(self.device)
-                label_devtensor = nodule_tensor.to(self.device)
+            self.logImageSamples_dict[mode_str] = sample_list
 
-                prediction_devtensor = self.model(input_devtensor.unsqueeze(0))[0]
-                prediction_ary = prediction_devtensor.to('cpu').detach().numpy()
-                label_ary = nodule_tensor.numpy()
-                ben_ary = ben_tensor.numpy()
-                mal_ary = mal_tensor.numpy()
+        return self.logImageSamples_dict[mode_str]
 
-                image_ary = np.zeros((512, 512, 3), dtype=np.float32)
-                image_ary[:,:,:] = (ct_tensor[dl.dataset.contextSlices_count].numpy().reshape((512,512,1)))
-                image_ary[:,:,0] += prediction_ary[0] * (1 - label_ary[0])  # Red
-                image_ary[:,:,1] += prediction_ary[0] * mal_ary  # Green
-                image_ary[:,:,2] += prediction_ary[0] * ben_ary  # Blue
+    def waitForImages(self):
+        # .result() re-raises anything that went wrong encoding or writing an image
+        for future in self.imageFuture_list:
+            future.result()
+        self.imageFuture_list = []
+
+    def logImages(self, epoch_ndx, mode_str, dl):
+        # Only rank 0 gets here, so bypass the DDP wrapper to avoid its collectives
+        model = getattr(self.model, 'module', self.model)
+
+        with torch.inference_mode():
+            for i, slice_ndx, ct_tensor, nodule_tensor, ben_tensor, mal_tensor in self.getLogImageSamples(mode_str, dl):
+                ct_devtensor = ct_tensor.to(self.device)
+                label_devtensor = nodule_tensor.to(self.device).float()
+                ben_devtensor = ben_tensor.to(self.device).float()
+                mal_devtensor = mal_tensor.to(self.device).float()
+                notLabel_devtensor = 1 - label_devtensor
+
+                input_devtensor = ct_devtensor.unsqueeze(0).contiguous(memory_format=torch.channels_last)
+                with torch.cuda.amp.autocast(enabled=self.use_cuda):
+                    prediction_devtensor = model(input_devtensor)[0, 0].float()
+
+                # Build the RGB image on the device and only copy the finished result back
+                image_devtensor = ct_devtensor[dl.dataset.contextSlices_count].repeat(3, 1, 1)
+                image_devtensor[0].addcmul_(prediction_devtensor, notLabel_devtensor)  # Red
+                image_devtensor[1].addcmul_(prediction_devtensor, mal_devtensor)  # Green
+                image_devtensor[2].addcmul_(prediction_devtensor, ben_devtensor)  # Blue
 
                 writer = getattr(self, mode_str + '_writer')
-                image_ary *= 0.5
-                image_ary[image_ary < 0] = 0
-                image_ary[image_ary > 1] = 1
-                writer.add_image('{}/{}_prediction_{}'.format(mode_str, i, slice_ndx), image_ary, self.totalTrainingSamples_count, dataformats='HWC')
+                image_devtensor.mul_(0.5).clamp_(0, 1)
+                self.imageFuture_list.append(self.image_pool.submit(writer.add_image, '{}/{}_prediction_{}'.format(mode_str, i, slice_ndx), image_devtensor.cpu().numpy(), self.totalTrainingSamples_count, dataformats='CHW'))
 
                 # self.diceLoss(label_devtensor, prediction_devtensor, p=True)
 
                 if epoch_ndx == 1:
-                    image_ary = np.zeros((512, 512, 3), dtype=np.float32)
-                    image_ary[:,:,:] = (ct_tensor[dl.dataset.contextSlices_count].numpy().reshape((512,512,1)))
-                    image_ary[:,:,0] += (1 - label_ary[0]) * ct_tensor[-1].numpy() # Red
-                    image_ary[:,:,1] += mal_ary  # Green
-                    image_ary[:,:,2] += ben_ary  # Blue
+                    image_devtensor = ct_devtensor[dl.dataset.contextSlices_count].repeat(3, 1, 1)
+                    image_devtensor[0].addcmul_(notLabel_devtensor, ct_devtensor[-1])  # Red
+                    image_devtensor[1].add_(mal_devtensor)  # Green
+                    image_devtensor[2].add_(ben_devtensor)  # Blue
 
                     writer = getattr(self, mode_str + '_writer')
-                    image_ary *= 0.5
-                    image_ary[image_ary < 0] = 0
-                    image_ary[image_ary > 1] = 1
-                    writer.add_image('{}/{}_label_{}'.format(mode_str, i, slice_ndx), image_ary, self.totalTrainingSamples_count, dataformats='HWC')
+                    image_devtensor.mul_(0.5).clamp_(0, 1)
+                    self.imageFuture_list.append(self.image_pool.submit(writer.add_image, '{}/{}_label_{}'.format(mode_str, i, slice_ndx), image_devtensor.cpu().numpy(), self.totalTrainingSamples_count, dataformats='CHW'))
 
 
     def logMetrics(self,
@@ -378,19 +715,29 @@ class LunaTrainingApp(object):
         mode_str,
         metrics_tensor,
     ):
-        self.initTensorboardWriters()
+        if self.is_rank0:
+            self.initTensorboardWriters()
         log.info("E{} {}".format(
             epoch_ndx,
             type(self).__name__,
         ))
 
-        metrics_ary = metrics_tensor.cpu().detach().numpy()
-        sum_ary = metrics_ary.sum(axis=1)
-        assert np.isfinite(metrics_ary).all()
+        # Do the reductions with torch wherever metrics_tensor lives, then move
+        # only the handful of resulting values over to numpy in one go
+        metrics_tensor = metrics_tensor.detach()
+        assert torch.isfinite(metrics_tensor).all()
+
+        malLabel_mask = (metrics_tensor[METRICS_LABEL_NDX] == 1) | (metrics_tensor[METRICS_LABEL_NDX] == 3)
 
-        malLabel_mask = (metrics_ary[METRICS_LABEL_NDX] == 1) | (metrics_ary[METRICS_LABEL_NDX] == 3)
+        # allLabel_mask = (metrics_tensor[METRICS_LABEL_NDX] == 2) | (metrics_tensor[METRICS_LABEL_NDX] == 3)
 
-        # allLabel_mask = (metrics_ary[METRICS_LABEL_NDX] == 2) | (metrics_ary[METRICS_LABEL_NDX] == 3)
+        summary_ary = torch.cat([
+            metrics_tensor.sum(dim=1),
+            metrics_tensor[METRICS_LOSS_NDX].mean().view(1),
+            metrics_tensor[METRICS_MAL_LOSS_NDX, malLabel_mask].mean().view(1),
+        ]).cpu().numpy()
+        sum_ary = summary_ary[:METRICS_SIZE]
+        allLoss_mean, malLoss_mean = summary_ary[METRICS_SIZE:]
 
         allLabel_count = sum_ary[METRICS_ATP_NDX] + sum_ary[METRICS_AFN_NDX]
         malLabel_count = sum_ary[METRICS_MTP_NDX] + sum_ary[METRICS_MFN_NDX]
@@ -403,9 +750,9 @@ class LunaTrainingApp(object):
 
 
         metrics_dict = {}
-        metrics_dict['loss/all'] = metrics_ary[METRICS_LOSS_NDX].mean()
-        metrics_dict['loss/mal'] = np.nan_to_num(metrics_ary[METRICS_MAL_LOSS_NDX, malLabel_mask].mean())
-        # metrics_dict['loss/all'] = metrics_ary[METRICS_ALL_LOSS_NDX, allLabel_mask].mean()
+        metrics_dict['loss/all'] = allLoss_mean
+        metrics_dict['loss/mal'] = np.nan_to_num(malLoss_mean)
+        # metrics_dict['loss/all'] = metrics_tensor[METRICS_ALL_LOSS_NDX, allLabel_mask].mean()
 
         metrics_dict['correct/mal'] = sum_ary[METRICS_MTP_NDX] / (sum_ary[METRICS_MTP_NDX] + sum_ary[METRICS_MFN_NDX]) * 100
         metrics_dict['correct/all'] = sum_ary[METRICS_ATP_NDX] / (sum_ary[METRICS_ATP_NDX] + sum_ary[METRICS_AFN_NDX]) * 100
@@ -446,12 +793,13 @@ class LunaTrainingApp(object):
             malLabel_count=malLabel_count,
             **metrics_dict,
         ))
-        writer = getattr(self, mode_str + '_writer')
+        if self.is_rank0:
+            writer = getattr(self, mode_str + '_writer')
 
-        prefix_str = 'seg_'
+            prefix_str = 'seg_'
 
-        for key, value in metrics_dict.items():
-            writer.add_scalar(prefix_str + key, value, self.totalTrainingSamples_count)
+            for key, value in metrics_dict.items():
+                writer.add_scalar(prefix_str + key, value, self.totalTrainingSamples_count)
 
         score = 1 \
             + metrics_dict['pr/f1_score'] \
@@ -485,6 +833,9 @@ class LunaTrainingApp(object):
     #             # print name, param.data
 
     def saveModel(self, type_str, epoch_ndx, isBest=False):
+        if epoch_ndx % self.cli_args.save_every != 0 and not isBest:
+            return
+
         file_path = os.path.join(
             'data-unversioned',
             'part2',
@@ -504,20 +855,20 @@ class LunaTrainingApp(object):
         if hasattr(model, 'module'):
             model = model.module
 
+        # Snapshot everything to the CPU now, since training keeps updating
+        # the live tensors while the background thread is writing them out
         state = {
-            'model_state': model.state_dict(),
+            'model_state': copyToCpu(model.state_dict()),
             'model_name': type(model).__name__,
-            'optimizer_state' : self.optimizer.state_dict(),
+            'optimizer_state' : copyToCpu(self.optimizer.state_dict()),
             'optimizer_name': type(self.optimizer).__name__,
             'epoch': epoch_ndx,
             'totalTrainingSamples_count': self.totalTrainingSamples_count,
         }
-        torch.save(state, file_path)
-
-        log.debug("Saved model params to {}".format(file_path))
+        filePath_list = [file_path]
 
         if isBest:
-            file_path = os.path.join(
+            filePath_list.append(os.path.join(
                 'data-unversioned',
                 'part2',
                 'models',
@@ -528,11 +879,20 @@ class LunaTrainingApp(object):
                     self.cli_args.comment,
                     'best',
                 )
-            )
-            torch.save(state, file_path)
+            ))
+
+        # Only one save in flight at a time, so a slow disk can't pile up snapshots in memory
+        if self.save_future is not None:
+            self.save_future.result()
+        self.save_future = self.save_pool.submit(self.writeState, state, filePath_list)
+
+    def writeState(self, state, filePath_list):
+        for file_path in filePath_list:
+            torch.save(state, file_path, _use_new_zipfile_serialization=True)
 
             log.debug("Saved model params to {}".format(file_path))
 
 
+# Multi-GPU: torchrun --nproc_per_node=<gpus> -m p2ch12.train_seg
 if __name__ == '__main__':
     sys.exit(LunaTrainingApp().main() or 0)